@@ -2,15 +2,20 @@
 # -*- coding: UTF-8 -*-
 
 from argparse import ArgumentParser
-from gzip import open as gzip_open
-from itertools import islice, chain, zip_longest
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BufferedReader, BufferedWriter
+from itertools import islice
+from os import cpu_count, remove, replace
+from os.path import join
 from pathlib import Path
 from pprint import pprint
-from re import search
-from shutil import copyfileobj
+from re import Pattern, compile as re_compile, escape, fullmatch, split
 from sys import exit
+from tempfile import SpooledTemporaryFile
 from time import perf_counter
-from typing import Union, Iterable
+from typing import BinaryIO, Iterator, TextIO
+from xml.sax.saxutils import escape as escape_xml
 
 try:
     from lxml import etree
@@ -18,6 +23,50 @@ except ModuleNotFoundError as e:
     print(e.msg, "Make sure it has been installed to the active environment!", sep='\n')
     exit(1)
 
+try:
+    # ISA-L compresses and decompresses several times faster than zlib, but it is optional
+    from isal import igzip_threaded
+    from isal.isal_zlib import error as DecompressionError
+    GZIP_COMPRESS_LEVEL = 1
+except ImportError:
+    # Also covers older isal releases that have no igzip_threaded module
+    from gzip import GzipFile
+    from zlib import error as DecompressionError
+    igzip_threaded = None
+    # Almost the same ratio as the default level 9, but several times faster
+    GZIP_COMPRESS_LEVEL = 6
+
+
+SITEMAP_NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+SITEMAP_HEAD = f'<?xml version="1.0" encoding="utf-8"?>\n<urlset xmlns="{SITEMAP_NAMESPACE}">'.encode('utf-8')
+SITEMAP_INDEX_HEAD = (
+    f'<?xml version="1.0" encoding="utf-8"?>\n<sitemapindex xmlns="{SITEMAP_NAMESPACE}">'.encode('utf-8')
+)
+# A raw carriage return would be read back as a line feed, so it's written as a character reference
+EXTRA_XML_ENTITIES = {'\r': '&#13;'}
+IO_BUFFER_SIZE = 128 * 1024
+# Output files are written under temporary names with this suffix and renamed when all of them are ready
+PART_FILE_SUFFIX = '.part'
+# Texts of all the tags but the first one are kept in memory up to this size, then moved to a temporary file
+SPILL_MAX_SIZE = 16 * 1024 * 1024
+# Formatting of sitemap files holds the GIL, so more writer threads than this don't make it faster
+MAX_WRITER_THREADS = 4
+# Only the text of the found tags is needed, so skip the whitespace-only nodes and the ID table,
+# and allow huge text nodes.
+# External DTDs and entities are never loaded: it's not needed and it's unsafe for untrusted files.
+# Entities declared inside the file itself are still resolved, since they can be a part of urls
+PARSER_OPTIONS = {
+    'remove_blank_text': True,
+    'huge_tree': True,
+    'collect_ids': False,
+    'recover': False,
+    'resolve_entities': 'internal',
+    'load_dtd': False,
+    'no_network': True,
+}
+# Symbols that are not allowed in output filenames. I'm not sure about this set of symbols!
+UNALLOWABLE_FILENAME_SYMBOLS = re_compile(r'[#<>$+%!`&*‘|{}?"=/:\\ @[\]]')
+
 
 def run() -> None:
     """Controls the general workflow. Also measures the script execution time and prints a report (if requested).
@@ -52,8 +101,9 @@ def create_parser() -> ArgumentParser:
     parser.add_argument('-f', '--file', type=Path, required=True,
                         help='Path to an XML-file (or a gz-archive with it)')
     parser.add_argument('-t', '--target tag(s)', nargs='*',
-                        help='Tag(s) to find and include in the sitemap (separated by space).'
-                             'See the "readme" for details!')
+                        help='Tag(s) to find and include in the sitemap (separated by space). '
+                             'A simple subset of XPath: tags ("{namespace}tag" and "{*}tag" too), "*", ".", '
+                             '"/" and "//", no predicates. See the "readme" for details!')
     parser.add_argument('-o', '--output dir', type=Path, default='./sitemap',
                         help='Path to the directory where the sitemap will be placed')
     parser.add_argument('-a', '--addresses per file', type=addresses_num_validator, default=50_000,
@@ -62,7 +112,8 @@ def create_parser() -> ArgumentParser:
                         help='URLs priority (from 0 to 1.0')
     parser.add_argument('-p', '--filename prefix', type=filename_prefix_validator, default='sitemap',
                         help='Prefix to use in output filenames, eg. "prefix.xml", "prefix1.xml"...')
-    parser.add_argument('-z', '--zip', action='store_true', help='Add sitemap archive files (.gz)')
+    parser.add_argument('-z', '--zip', action='store_true', help='Write sitemap files as archives (.gz)')
+    parser.add_argument('-P', '--pretty', action='store_true', help='Indent output files to make them human-readable')
     parser.add_argument('-r', '--report', action='store_true', help='Print a short report')
 
     return parser
@@ -108,7 +159,7 @@ def filename_prefix_validator(prefix: str) -> str:
 
     :return: The same string
     """
-    if search(r'[#<>$+%!`&*‘|{}?"=/:\\ @[\]]', prefix):  # I'm not sure about this set of symbols!
+    if UNALLOWABLE_FILENAME_SYMBOLS.search(prefix):
         raise ValueError
     return prefix
 
@@ -128,139 +179,434 @@ def handle(options: dict, report: dict) -> tuple[dict, bool]:
     urls_priority: float = options['url priority']
     prefix: str = options['filename prefix']
     need_zip: bool = options['zip']
+    pretty: bool = options['pretty']
     tags: list[str] = options['target tag(s)']
     need_report: bool = options['report']
 
     input_xml_file = input_xml_file.resolve()
-    try:
-        parsed_xml_tree = etree.parse(input_xml_file)
-    except IOError:
+    if not input_xml_file.is_file():
         print(f'File "{input_xml_file}" does not exist')
         exit(1)
-    except etree.XMLSyntaxError:
-        print(f'File "{input_xml_file}" contains invalid elements')
-        exit(1)
 
     output_dir = output_dir.resolve()
     output_dir.mkdir(parents=True, exist_ok=True)
-    report['sitemap path'] = str(output_dir)
-
-    # Make a sitemap-index tree. It will be need if there are more than one sitemap files
-    sitemap_index_root = etree.Element('sitemapindex', xmlns="http://www.sitemaps.org/schemas/sitemap/0.9")
-    sitemap_index_tree = etree.ElementTree(sitemap_index_root)
+    output_dir_path = str(output_dir)
+    report['sitemap path'] = output_dir_path
 
     # Get iterators based on the specified tags
-    element_iterators, report = get_element_iterators(parsed_xml_tree, tags, report)
+    element_iterators, report = get_element_iterators(input_xml_file, tags, report)
+
+    # The sitemap-index is written along with the sitemap files, if there are more than one of them.
+    # All the files get their names only at the end, so a failed run doesn't break the sitemap of the previous one
+    sitemap_index_file = output_dir / 'sitemap-index.xml'
+    sitemap_index_part_file = output_dir / f'sitemap-index.xml{PART_FILE_SUFFIX}'
+    sitemap_index_template = make_sitemap_index_template(pretty)
+    sitemap_index_output = None
+
+    # The priority is the same for all urls, so it's formatted into the url template once for all files
+    url_template = make_url_template(urls_priority, pretty)
+
+    # Collect entries for sitemap files until the iterator is empty and pass them to writer threads.
+    # The input file is parsed lazily, so errors in it can only show up here
+    sitemap_files = []
+    input_error = None
+    writer_threads = get_writer_threads(input_xml_file.suffix == '.gz', need_zip)
+    with ThreadPoolExecutor(max_workers=writer_threads) as executor:
+        pending_writes = deque()
+        try:
+            while True:
+                try:
+                    entries, report = collect_sitemap_entries(element_iterators, entries_number, report)
+                except (etree.XMLSyntaxError, EOFError, OSError, DecompressionError) as error:
+                    input_error = error
+                    break
+
+                if not entries:
+                    break
+
+                output_file_path, report = get_sitemap_file_path(output_dir_path, prefix, need_zip, report)
+                sitemap_files.append(output_file_path)
+                pending_writes.append(executor.submit(write_sitemap, entries, url_template,
+                                                      output_file_path + PART_FILE_SUFFIX, need_zip, pretty))
+                # Don't let the parsing run too far ahead of the writing
+                if len(pending_writes) > 2 * writer_threads:
+                    pending_writes.popleft().result()
+
+                if len(sitemap_files) == 2:
+                    sitemap_index_output = sitemap_index_part_file.open('wb', buffering=IO_BUFFER_SIZE)
+                    sitemap_index_output.write(SITEMAP_INDEX_HEAD + b'\n' if pretty else SITEMAP_INDEX_HEAD)
+                    sitemap_index_output.write((sitemap_index_template % escape_xml(sitemap_files[0])).encode('utf-8'))
+                if sitemap_index_output is not None:
+                    sitemap_index_output.write((sitemap_index_template % escape_xml(output_file_path)).encode('utf-8'))
+
+            if input_error is None:
+                for write in pending_writes:
+                    write.result()
+                if sitemap_index_output is not None:
+                    sitemap_index_output.write(b'</sitemapindex>\n')
+        finally:
+            if sitemap_index_output is not None:
+                sitemap_index_output.close()
+
+    if input_error is not None:
+        # Don't leave an incomplete sitemap behind
+        for output_file_path in sitemap_files:
+            remove(output_file_path + PART_FILE_SUFFIX)
+        sitemap_index_part_file.unlink(missing_ok=True)
+
+        if isinstance(input_error, etree.XMLSyntaxError):
+            print(f'File "{input_xml_file}" contains invalid elements')
+        else:
+            print(f'File "{input_xml_file}" is damaged or can\'t be read')
+        exit(1)
 
-    # Create sitemap trees and write them to files until the iterator is empty
-    while True:
-        sitemap_tree, report = make_sitemap_tree(element_iterators, entries_number, urls_priority, report)
+    for output_file_path in sitemap_files:
+        replace(output_file_path + PART_FILE_SUFFIX, output_file_path)
+    if sitemap_index_output is not None:
+        sitemap_index_part_file.replace(sitemap_index_file)
+        report['sitemap-index created'] = 1
 
-        if not len(sitemap_tree.getroot()):
-            break
+    return report, need_report
 
-        output_file_path, report = write_sitemap_tree(sitemap_tree, output_dir, prefix, need_zip, report)
 
-        sitemap_index_sitemap = etree.SubElement(sitemap_index_root, 'sitemap')
-        etree.SubElement(sitemap_index_sitemap, 'loc').text = str(output_file_path)
+def get_writer_threads(input_zipped: bool, output_zipped: bool) -> int:
+    """Chooses the number of threads writing sitemap files, so that all the threads of the script fit the cores.
+    One core is left for the main thread parsing the input, one more for the ISA-L thread decompressing it.
+    If ISA-L compresses the output, every writer thread has a compression thread of its own.
 
-    # Write the sitemap-index tree to a file if there are multiple sitemap files
-    if len(sitemap_index_root) > 1:
-        report = write_sitemap_index_tree(sitemap_index_tree, output_dir, report)
+    :param input_zipped: Is the input file a gz-archive
+    :param output_zipped: Is files archiving required
 
-    return report, need_report
+    :return: A number of writer threads
+    """
+    free_cores = (cpu_count() or 1) - 1
+    if igzip_threaded is not None:
+        if input_zipped:
+            free_cores -= 1
+        if output_zipped:
+            free_cores //= 2
 
+    return min(max(free_cores, 1), MAX_WRITER_THREADS)
 
-def get_element_iterators(element: Union[etree.Element, etree.ElementTree], xpath_expressions: list[str],
-                          report: dict) -> tuple[chain, dict]:
+
+def get_element_iterators(input_xml_file: Path, xpath_expressions: list[str],
+                          report: dict) -> tuple[deque[tuple[Iterator, str]], dict]:
     """Takes a tag(s) to be found in an upload data file and returns an iterator(s) with the found elements.
     Also fills the report dict with data for further tags counting.
+    The file is not loaded into memory as a whole and is parsed only once for all the tags. The texts of the first
+    tag are passed on right away, the texts of the others are spilled while parsing and read back afterwards,
+    so the texts are still grouped by tags.
 
-    :param element: An instance of ElementTree or Element. In the latter case it must be the root of the tree
+    :param input_xml_file: A path to an XML-file (or a gz-archive with it)
     :param xpath_expressions: A tag(s) to be found. It must be represented as XPath expressions.
         See the "readme" for more information
     :param report: A dict for collecting report data
 
-    :return: (An iterator that returns item: (ElementTree instance, XPath expression), Report data dict)
+    :return: (A queue of items: (An iterator that returns texts of found elements, XPath expression),
+        Report data dict)
     """
     report['tags handled'] = dict.fromkeys(xpath_expressions, 0)
-    iterators = []
+    if not xpath_expressions:
+        return deque(), report
+
+    path_patterns = []
+    tags = set()
     for x_path in xpath_expressions:
         try:
-            iterators.append(zip_longest(element.iterfind(x_path), [], fillvalue=x_path))
+            path_pattern, tag = compile_xpath(x_path)
         except SyntaxError:
             print(f'Wrong syntax of the tag "{x_path}". See the "readme" for help!')
             exit(1)
+        path_patterns.append(path_pattern)
+        tags.add(tag)
+
+    spills = [SpooledTemporaryFile(max_size=SPILL_MAX_SIZE, mode='w+', encoding='utf-8', newline='')
+              for _ in xpath_expressions[1:]]
+    iterators = deque([(iter_matching_texts(input_xml_file, path_patterns, tags, spills), xpath_expressions[0])])
+    iterators.extend((iter_spilled_texts(spill), x_path) for spill, x_path in zip(spills, xpath_expressions[1:]))
+
+    return iterators, report
+
+
+def compile_xpath(x_path: str) -> tuple[Pattern, str]:
+    """Converts a simple XPath expression into a regular expression matching element paths, and finds the tag
+    the expression selects. A path is made of the tags of an element and its ancestors up to the root (not included),
+    each preceded by "\\0", which can't appear in XML (unlike "/", which can appear in a namespace).
+    Only tags, "*", "." and the "/" and "//" separators are supported. A tag can be given with a namespace,
+    as "{namespace}tag", or with any namespace, as "{*}tag". Predicates ("[...]") are not supported.
+    As with the ElementTree search, the expression is applied relative to the root element,
+    even if it begins with "/".
+
+    :param x_path: An XPath expression
+
+    :raise SyntaxError: If the expression contains unsupported syntax
+
+    :return: (A compiled regular expression, The tag of the last step)
+    """
+    # Slashes inside a namespace are not separators
+    steps = split(r'(//?)(?![^{]*})', x_path)
+    if steps[0] in ('', '.'):
+        steps = steps[1:]
+    else:
+        steps.insert(0, '/')
+
+    if not steps or steps[-1] in ('', '/', '//'):
+        raise SyntaxError(x_path)
+
+    pattern = ''
+    tag = None
+    for separator, step in zip(steps[::2], steps[1::2]):
+        if separator == '//':
+            pattern += '(?:\0[^\0]+)*'
+        if step == '.':
+            continue
+        # A tag name must start with a letter or an underscore, so ".." and the like are rejected here
+        step_match = fullmatch(r'({[^{}]*})?([^\W\d][\w.-]*|\*)', step)
+        if step_match is None:
+            raise SyntaxError(x_path)
+
+        namespace, name = step_match.groups()
+        if namespace is None:
+            # A tag without a namespace, or any tag if it's "*"
+            pattern += '\0' + ('[^\0]+' if name == '*' else escape(name))
+        elif namespace == '{*}':
+            pattern += '\0' + ('[^\0]+' if name == '*' else '(?:{[^}]*})?' + escape(name))
+        elif namespace == '{}':
+            pattern += '\0' + ('[^{\0][^\0]*' if name == '*' else escape(name))
+        else:
+            pattern += '\0' + escape(namespace) + ('[^\0]+' if name == '*' else escape(name))
+        tag = step
+
+    # The root element itself is never matched
+    if tag is None:
+        raise SyntaxError(x_path)
+
+    return re_compile(pattern), tag
+
+
+def iter_matching_texts(input_xml_file: Path, path_patterns: list[Pattern], tags: set[str],
+                        spills: list[TextIO]) -> Iterator[str]:
+    """Parses the file incrementally and finds the elements whose path matches any of the patterns.
+    The parser reports only the elements with the given tags, so the path is checked just for them.
+    The texts matching the first pattern are yielded, the texts matching the others are written to the spills.
+    Elements without text are skipped. The texts come out in the document order (by opening tags), even for nested
+    matches. Every reported element is cleared at its end, and everything before it and its ancestors is detached
+    from the tree ("fast iter"), so memory usage doesn't depend on the file size.
+
+    :param input_xml_file: A path to an XML-file (or a gz-archive with it)
+    :param path_patterns: Patterns made by compile_xpath()
+    :param tags: Tags of the last steps of the patterns, as returned by compile_xpath()
+    :param spills: Files for the texts of all the patterns but the first one. Texts are terminated by "\\0",
+        which can't appear in XML
+
+    :return: An iterator that yields texts of elements matching the first pattern
+    """
+    matches = {}
+    # A match slot [text, pattern indexes] for every open reported element, or None if it doesn't match
+    slots = []
+    # Match slots in the document order. A text is passed on only when all the texts before it are known
+    pending = deque()
+    spill_writes = [spill.write for spill in spills]
+
+    with open_input_file(input_xml_file) as xml_input:
+        context = etree.iterparse(xml_input, events=('start', 'end'), tag=tags, **PARSER_OPTIONS)
+        for event, elem in context:
+            if event == 'start':
+                path_tags = [i_ancestor.tag for i_ancestor in elem.iterancestors()]
+                # The root element itself is never matched, so it's not a part of the path
+                if path_tags:
+                    path_tags.pop()
+                    path_tags.reverse()
+                    path_tags.append(elem.tag)
+                    path = '\0' + '\0'.join(path_tags)
+                    indexes = matches.get(path)
+                    if indexes is None:
+                        indexes = matches[path] = tuple(
+                            i for i, pattern in enumerate(path_patterns) if pattern.fullmatch(path)
+                        )
+                else:
+                    indexes = None
+                slot = [None, indexes] if indexes else None
+                if slot is not None:
+                    pending.append(slot)
+                slots.append(slot)
+                continue
+
+            slot = slots.pop()
+            if slot is not None:
+                # The text is complete only at the closing tag
+                slot[0] = elem.text or ''
+                while pending and pending[0][0] is not None:
+                    text, indexes = pending.popleft()
+                    if not text:
+                        continue
+                    for i in indexes:
+                        if i:
+                            spill_writes[i - 1](text + '\0')
+                        else:
+                            yield text
+
+            elem.clear()
+            # Other elements are not reported, so they are detached along with the previous siblings of the ancestors.
+            # Comments and processing instructions before the root are its siblings, but they have no parent
+            parent = elem.getparent()
+            while parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+                elem, parent = parent, parent.getparent()
+        del context
+
+
+def iter_spilled_texts(spill: TextIO) -> Iterator[str]:
+    """Reads back the texts written to a spill by iter_matching_texts() and closes it.
+    It must not be started before the parsing is over.
+
+    :param spill: A spill file
+
+    :return: An iterator that yields texts from the spill
+    """
+    with spill:
+        spill.seek(0)
+        rest = ''
+        while True:
+            chunk = spill.read(IO_BUFFER_SIZE)
+            if not chunk:
+                break
+            *texts, rest = (rest + chunk).split('\0')
+            yield from texts
+
+
+def open_input_file(input_xml_file: Path) -> BinaryIO:
+    """Opens an upload data file for reading. A gz-archive is decompressed on the fly.
+    The stream is buffered with large chunks to reduce the number of read calls to the file and to zlib.
+    If ISA-L is available, decompression runs in a separate thread.
 
-    return chain(*iterators), report
+    :param input_xml_file: A path to an XML-file (or a gz-archive with it)
 
+    :return: A readable binary stream
+    """
+    if input_xml_file.suffix != '.gz':
+        return input_xml_file.open('rb', buffering=IO_BUFFER_SIZE)
+    if igzip_threaded is not None:
+        return igzip_threaded.open(input_xml_file, 'rb', threads=1)
+    return BufferedReader(GzipFile(input_xml_file, 'rb'), buffer_size=IO_BUFFER_SIZE)
+
+
+def open_output_file(output_file: str, zipped: bool) -> BinaryIO:
+    """Opens a sitemap file for writing. A gz-archive is compressed on the fly.
+    The stream is buffered with large chunks to reduce the number of write calls to the file and to zlib.
+    If ISA-L is available, compression runs in a separate thread while the calling one keeps writing XML.
+
+    :param output_file: A path to a sitemap file (or a gz-archive with it)
+    :param zipped: Is the file a gz-archive
+
+    :return: A writable binary stream
+    """
+    if not zipped:
+        return open(output_file, 'wb', buffering=IO_BUFFER_SIZE)
+    if igzip_threaded is not None:
+        return igzip_threaded.open(output_file, 'wb', compresslevel=GZIP_COMPRESS_LEVEL, threads=1)
+    return BufferedWriter(GzipFile(output_file, 'wb', compresslevel=GZIP_COMPRESS_LEVEL), buffer_size=IO_BUFFER_SIZE)
 
-def make_sitemap_tree(iterators: Iterable, entries_num: int, url_priority: float,
-                      report: dict) -> tuple[etree.ElementTree, dict]:
-    """Creates a sitemap tree (ElementTree), adds elements there and counts the number of handled tags.
 
-    :param iterators: An iterator that yields tree elements (Element) and tag names
+def collect_sitemap_entries(iterators: deque[tuple[Iterator, str]], entries_num: int,
+                            report: dict) -> tuple[list[str], dict]:
+    """Takes the next portion of found elements and counts the number of handled tags.
+    The iterators are drained one by one, exhausted ones are removed from the queue.
+    Tags are counted once per iterator and portion instead of once per element.
+
+    :param iterators: A queue of iterators that yield texts of found elements with tag names
     :param entries_num: A number of entries per sitemap file
-    :param url_priority: A value of url priority in a sitemap
     :param report: A dict for collecting report data
 
-    :return: (An ElementTree filled by data, Report data dict)
+    :return: (A list of texts of the elements, Report data dict)
     """
-    sitemap_root = etree.Element('urlset', xmlns="http://www.sitemaps.org/schemas/sitemap/0.9")
-    sitemap_tree = etree.ElementTree(sitemap_root)
-    url_priority = str(url_priority)
-
-    for i_elem, i_tag in islice(iterators, entries_num):
-        if i_elem.text:
-            sitemap_url = etree.SubElement(sitemap_root, 'url')
-            etree.SubElement(sitemap_url, 'loc').text = i_elem.text
-            etree.SubElement(sitemap_url, 'priority').text = url_priority
-            report['tags handled'][i_tag] += 1
+    entries = []
+    while iterators and len(entries) < entries_num:
+        iterator, tag = iterators[0]
+        handled_before = len(entries)
+        remaining = entries_num - handled_before
+        # The tag is the same for the whole iterator, so the texts can be taken without a Python-level loop
+        entries.extend(islice(iterator, remaining))
+        handled = len(entries) - handled_before
+        report['tags handled'][tag] += handled
+        if handled < remaining:
+            iterators.popleft()
 
-    return sitemap_tree, report
+    return entries, report
 
 
-def write_sitemap_tree(tree: etree.ElementTree, output_path: Path, filename_prefix: str, zipped: bool,
-                       report: dict) -> tuple[Path, dict]:
-    """Writes the sitemap tree to a file and counts the number of created files. Also archives files if required.
+def get_sitemap_file_path(output_path: str, filename_prefix: str, zipped: bool, report: dict) -> tuple[str, dict]:
+    """Makes a path for the next sitemap file and counts the number of created files.
+    Paths are plain strings here, since it's called for every sitemap file and Path objects aren't free.
 
-    :param tree: An ElementTree instance
     :param output_path: A directory path for sitemap output files
     :param filename_prefix: A prefix to be included to the file name
     :param zipped: Is files archiving required
     :param report: A dict for collecting report data
 
-    :return: (A path to the created file, Report data dict)
+    :return: (A path to the sitemap file, Report data dict)
     """
     file_number = report.get('sitemap files created', 0)
-    output_file = output_path / f'{filename_prefix}{file_number or ""}.xml'
+    output_file = join(output_path, f'{filename_prefix}{file_number or ""}.xml{".gz" if zipped else ""}')
     report['sitemap files created'] = file_number + 1
 
-    with output_file.open('wb+') as xml_output:
-        tree.write(xml_output, pretty_print=True, encoding='utf-8', xml_declaration=True)
-        if zipped:
-            with gzip_open(output_file.with_suffix('.xml.gz'), 'wb') as zipped_file:
-                # This way is faster than rewriting by the tree method - tree.write(zipped_file)
-                xml_output.seek(0)
-                copyfileobj(xml_output, zipped_file)
-
     return output_file, report
 
 
-def write_sitemap_index_tree(tree: etree.ElementTree, output_path: Path, report: dict) -> dict:
-    """Writes the sitemap-index tree to a file and sets the number of created sitemap-index files to 1.
+def make_sitemap_index_template(pretty: bool) -> str:
+    """Makes a template of a sitemap-index entry. The sitemap file path is to be substituted with the % operator.
 
-    :param tree: An ElementTree instance
-    :param output_path: A directory path for sitemap-index output file
-    :param report: A dict for collecting report data
+    :param pretty: Is indentation of the output required
 
-    :return: Report data dict
+    :return: A template string
     """
-    output_sitemap_index_file = output_path / 'sitemap-index.xml'
-    tree.write(output_sitemap_index_file, pretty_print=True, encoding='utf-8', xml_declaration=True)
-    report['sitemap-index created'] = 1
+    if pretty:
+        return '  <sitemap>\n    <loc>%s</loc>\n  </sitemap>\n'
+    return '<sitemap><loc>%s</loc></sitemap>'
+
 
-    return report
+def make_url_template(url_priority: float, pretty: bool) -> str:
+    """Makes a template of a sitemap url entry with the priority already filled in.
+    The url text is to be substituted with the % operator.
+
+    :param url_priority: A value of url priority in a sitemap
+    :param pretty: Is indentation of the output required
+
+    :return: A template string
+    """
+    if pretty:
+        return f'  <url>\n    <loc>%s</loc>\n    <priority>{url_priority}</priority>\n  </url>\n'
+    return f'<url><loc>%s</loc><priority>{url_priority}</priority></url>'
+
+
+def write_sitemap(entries: list[str], url_template: str, output_file: str, zipped: bool, pretty: bool) -> None:
+    """Writes entries to a sitemap file. Every url has the same fixed shape, so it's formatted from a template
+    straight into bytes, without creating any lxml elements. It is written as a gz-archive if archiving is required.
+    Runs in a writer thread, so it must not touch any shared data.
+
+    :param entries: Texts to be included in the sitemap
+    :param url_template: A template made by make_url_template()
+    :param output_file: A path to the sitemap file
+    :param zipped: Is files archiving required
+    :param pretty: Is indentation of the output required
+
+    :return: None
+    """
+    # URLs rarely contain XML special characters, so the escaping is skipped if there are none.
+    # All urls are encoded and written at once instead of making a write call for each of them
+    urls = ''.join([
+        url_template % (
+            escape_xml(i_text, EXTRA_XML_ENTITIES)
+            if '&' in i_text or '<' in i_text or '>' in i_text or '\r' in i_text else i_text
+        )
+        for i_text in entries
+    ])
+
+    with open_output_file(output_file, zipped) as xml_output:
+        xml_output.write(SITEMAP_HEAD + b'\n' if pretty else SITEMAP_HEAD)
+        xml_output.write(urls.encode('utf-8'))
+        xml_output.write(b'</urlset>\n')
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+from gzip import open as gzip_open
 from itertools import islice
 from pathlib import Path
 
@@ -7,11 +8,25 @@ from lxml import etree
 UPLOAD_DATA_FILE = './articles.xml.gz'
 FILENAME_PREFIX = 'sitemap'
 URL_PRIORITY = '0.3'
-TARGET_NODE = '//offer/url'
+TARGET_TAG, TARGET_PARENT_TAG = 'url', 'offer'  # '//offer/url'
 
-parsed_xml_tree = etree.parse(UPLOAD_DATA_FILE)
 
-iterator = parsed_xml_tree.iterfind(TARGET_NODE)
+def iter_target_nodes(xml_input):
+    # Stream the file instead of building the whole tree. Only the target tags are reported, so every one of them
+    # is dropped along with all the nodes before it and its ancestors
+    for _, node in etree.iterparse(xml_input, events=('end',), tag=TARGET_TAG):
+        parent = node.getparent()
+        if parent is not None and parent.tag == TARGET_PARENT_TAG:
+            yield node
+        node.clear()
+        while parent is not None:
+            while node.getprevious() is not None:
+                del parent[0]
+            node, parent = parent, parent.getparent()
+
+
+xml_input = gzip_open(UPLOAD_DATA_FILE, 'rb')
+iterator = iter_target_nodes(xml_input)
 
 sitemap_root = etree.Element('urlset', xmlns="http://www.sitemaps.org/schemas/sitemap/0.9")
 sitemap_tree = etree.ElementTree(sitemap_root)
@@ -28,7 +43,9 @@ while True:
 
     output_sitemap_file = Path() / f'{FILENAME_PREFIX}_{str(sitemap_file_number).zfill(2)}.xml'
     with output_sitemap_file.open('wb') as xml_output:
-        sitemap_tree.write(xml_output, pretty_print=True, encoding='utf-8', xml_declaration=True)
+        sitemap_tree.write(xml_output, pretty_print=False, encoding='utf-8', xml_declaration=True)
 
     sitemap_root.clear()
     sitemap_file_number += 1
+
+xml_input.close()